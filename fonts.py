@@ -0,0 +1,474 @@
+import asyncio
+import hashlib
+import json
+import os
+import re
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from PIL import ImageFont
+from astrbot.api import logger
+
+UPSTREAM_BASE = "https://github.com/adobe-fonts/source-han-sans/raw/release/OTF/SimplifiedChinese/"
+
+# 字重 -> 上游文件名；sha256 可在配置 font_sha256 中按字重填写
+FONT_SPECS = {
+    "heavy":   {"file": "SourceHanSansSC-Heavy.otf",   "sha256": None},
+    "bold":    {"file": "SourceHanSansSC-Bold.otf",    "sha256": None},
+    "medium":  {"file": "SourceHanSansSC-Medium.otf",  "sha256": None},
+    "regular": {"file": "SourceHanSansSC-Regular.otf", "sha256": None},
+}
+
+# 缺少某个字重时，按顺序借用已有的字重
+WEIGHT_FALLBACK = {
+    "heavy":   ["heavy", "bold", "medium", "regular"],
+    "bold":    ["bold", "heavy", "medium", "regular"],
+    "medium":  ["medium", "regular", "bold", "heavy"],
+    "regular": ["regular", "medium", "bold", "heavy"],
+}
+
+DEFAULT_MIRRORS = ["https://ghproxy.net/"]
+
+CHUNK_SIZE = 64 * 1024
+
+# 一轮供给失败后，至少间隔这么久才会被渲染请求再次触发
+RETRY_INTERVAL = 600
+
+# 记录已校验字体的大小与 sha256，没有记录的字体文件视为未校验
+MANIFEST_NAME = "manifest.json"
+
+
+class FontManager:
+    """字体供给：本地/系统字体优先，缺失的字重在后台并行下载，渲染永不等待。"""
+
+    def __init__(self, config, storage_instance):
+        self.font_dir = storage_instance.font_dir
+        self.upstream_base = UPSTREAM_BASE
+        self.timeout = 30
+        self.retry_interval = RETRY_INTERVAL
+
+        hashes = config.get("font_sha256") or {}
+        self.specs = {}
+        for weight, spec in FONT_SPECS.items():
+            digest = (hashes.get(weight) or spec["sha256"] or "").strip().lower()
+            self.specs[weight] = {"file": spec["file"], "sha256": digest or None}
+
+        self.mirrors = self._normalize_mirrors(config.get("font_mirrors"))
+
+        local_dir = (config.get("font_local_dir") or "").strip()
+        self.local_dir = Path(local_dir).expanduser() if local_dir else None
+        self.system_dirs = self._system_font_dirs() if config.get("font_use_system", True) else []
+
+        self._resolved = {}
+        self._unverified = set()
+        self._checked = set()
+        self._bad = set()
+        self._manifest = None
+        self._lock = threading.RLock()
+        self._stop = threading.Event()
+        self._task = None
+        self._last_failed = None
+
+        # 本地目录只列一层，开销可控，同步完成以保证首次渲染就能用上
+        if self.local_dir:
+            self._scan_local_sources([self.local_dir], recursive=False)
+
+    @staticmethod
+    def _normalize_mirrors(mirrors) -> list:
+        # 未配置时用默认镜像；用户清空列表则只直连
+        if mirrors is None: mirrors = DEFAULT_MIRRORS
+        result = []
+        for m in mirrors:
+            if not isinstance(m, str) or not m.strip(): continue
+            m = m.strip()
+            if not m.endswith("/"): m += "/"
+            if m not in result: result.append(m)
+        # 直连始终作为最后一个候选
+        result.append("")
+        return result
+
+    # --- 查询 ---
+
+    def target_path(self, weight) -> Path:
+        return self.font_dir / f"font_{weight}.otf"
+
+    def available(self) -> dict:
+        """返回当前可用的 {字重: 路径}，未校验但能加载的下载文件也先拿来渲染"""
+        with self._lock:
+            found = dict(self._resolved)
+        for weight in self.specs:
+            if weight in found: continue
+            path = self.target_path(weight)
+            with self._lock:
+                skip = path in self._bad or path in self._checked
+            if skip or not path.exists(): continue
+            if self._check_target(weight, path):
+                found[weight] = path
+        with self._lock:
+            self._resolved.update(found)
+        return found
+
+    def missing(self) -> list:
+        """尚未就绪或未经校验、需要后台处理的字重"""
+        found = self.available()
+        with self._lock:
+            unverified = set(self._unverified)
+        return [w for w in self.specs if w not in found or w in unverified]
+
+    def get_font(self, size, weight="regular"):
+        """取最接近的已就绪字重；一个都没有时退回 Pillow 默认字体"""
+        found = self.available()
+        for candidate in WEIGHT_FALLBACK.get(weight, WEIGHT_FALLBACK["regular"]):
+            path = found.get(candidate)
+            if not path: continue
+            try:
+                return ImageFont.truetype(str(path), int(size))
+            except OSError:
+                self._discard(candidate, path)
+        try:
+            return ImageFont.load_default(size=int(size))
+        except TypeError:
+            return ImageFont.load_default()
+
+    def _check_target(self, weight, path: Path) -> bool:
+        """下载目录里的字体只在首次使用时核对一次清单，不符的删除以便重新下载"""
+        entry = self._load_manifest().get(path.name)
+        if entry:
+            expected = self.specs[weight]["sha256"]
+            try:
+                digest = self._sha256(path) if path.stat().st_size == entry.get("size") else None
+            except OSError:
+                return False
+            if digest and digest == entry.get("sha256") and (not expected or digest == expected):
+                with self._lock:
+                    self._checked.add(path)
+                return True
+            self._remove_target(path, "与校验清单不符")
+            return False
+
+        # 旧版本留下的文件：Pillow 能打开不代表完整，先用着，后台再核对
+        if self._is_loadable(path):
+            with self._lock:
+                self._checked.add(path)
+                self._unverified.add(weight)
+            logger.info(f"[Menu] 字体 {path.name} 未经校验，将在后台核对")
+            return True
+        self._remove_target(path, "无法加载")
+        return False
+
+    def _remove_target(self, path: Path, reason):
+        logger.warning(f"[Menu] 字体文件{reason}，已删除等待重新下载: {path}")
+        try:
+            path.unlink(missing_ok=True)
+        except OSError:
+            with self._lock:
+                self._bad.add(path)
+        self._forget(path)
+
+    def _discard(self, weight, path: Path):
+        with self._lock:
+            self._resolved.pop(weight, None)
+            self._unverified.discard(weight)
+            self._checked.discard(path)
+        if path.parent == self.font_dir:
+            self._remove_target(path, "损坏")
+        else:
+            logger.warning(f"[Menu] 字体文件损坏，已忽略: {path}")
+            with self._lock:
+                self._bad.add(path)
+
+    # --- 校验清单 ---
+
+    def _load_manifest(self) -> dict:
+        with self._lock:
+            if self._manifest is None:
+                try:
+                    with open(self.font_dir / MANIFEST_NAME, "r", encoding="utf-8") as f:
+                        self._manifest = json.load(f)
+                except (OSError, ValueError):
+                    self._manifest = {}
+            return self._manifest
+
+    def _save_manifest(self):
+        path = self.font_dir / MANIFEST_NAME
+        tmp = path.with_name(path.name + ".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self._manifest, f, indent=4)
+        os.replace(tmp, path)
+
+    def _record(self, name, source: Path):
+        entry = {"size": source.stat().st_size, "sha256": self._sha256(source)}
+        with self._lock:
+            self._load_manifest()[name] = entry
+            self._save_manifest()
+
+    def _forget(self, path: Path):
+        with self._lock:
+            self._checked.discard(path)
+            if self._load_manifest().pop(path.name, None) is not None:
+                try: self._save_manifest()
+                except OSError: pass
+
+    # --- 供给 ---
+
+    def ensure_background(self, force=False):
+        """在后台补齐缺失字重；进行中、已关闭或处于失败冷却期时直接返回"""
+        if self._stop.is_set():
+            return None
+        if self._task and not self._task.done():
+            return self._task
+        if not force and self._last_failed is not None \
+                and time.monotonic() - self._last_failed < self.retry_interval:
+            return None
+        if not self.missing():
+            return None
+        self._task = asyncio.create_task(self.ensure_fonts())
+        return self._task
+
+    async def ensure_fonts(self):
+        try:
+            await asyncio.to_thread(self.ensure_fonts_sync)
+        except Exception as e:
+            self._last_failed = time.monotonic()
+            logger.error(f"[Menu] 字体准备失败: {e}")
+
+    def ensure_fonts_sync(self) -> dict:
+        self.font_dir.mkdir(parents=True, exist_ok=True)
+        if self.system_dirs:
+            self._scan_local_sources(self.system_dirs, recursive=True)
+
+        pending = self.missing()
+        if pending:
+            logger.info(f"[Menu] 开始准备字体: {', '.join(pending)}")
+            with ThreadPoolExecutor(max_workers=len(pending)) as pool:
+                results = list(pool.map(self._fetch_weight, pending))
+            for weight, ok in zip(pending, results):
+                if not ok:
+                    logger.warning(f"[Menu] 字体 {weight} 所有镜像均下载失败，将使用替代字重")
+
+        if self.missing():
+            self._last_failed = time.monotonic()
+        else:
+            self._last_failed = None
+        return self.available()
+
+    async def close(self, timeout=5.0):
+        """停止后台供给并等待下载线程退出，已下载的部分保留以便续传"""
+        self._stop.set()
+        if self._task and not self._task.done():
+            await asyncio.wait([self._task], timeout=timeout)
+
+    # --- 本地来源 ---
+
+    @staticmethod
+    def _system_font_dirs() -> list:
+        if sys.platform.startswith("win"):
+            windir = os.environ.get("WINDIR", r"C:\Windows")
+            dirs = [Path(windir) / "Fonts"]
+            local = os.environ.get("LOCALAPPDATA")
+            if local: dirs.append(Path(local) / "Microsoft" / "Windows" / "Fonts")
+            return dirs
+        if sys.platform == "darwin":
+            return [Path("/System/Library/Fonts"), Path("/Library/Fonts"), Path.home() / "Library" / "Fonts"]
+        return [Path("/usr/share/fonts"), Path("/usr/local/share/fonts"),
+                Path.home() / ".local" / "share" / "fonts", Path.home() / ".fonts"]
+
+    @staticmethod
+    def _local_candidates(weight, spec) -> list:
+        title = weight.capitalize()
+        return [spec["file"], f"font_{weight}.otf",
+                f"SourceHanSansCN-{title}.otf", f"NotoSansSC-{title}.otf", f"NotoSansCJKsc-{title}.otf"]
+
+    def _scan_local_sources(self, dirs, recursive=True):
+        with self._lock:
+            pending = [w for w in self.specs if w not in self._resolved or w in self._unverified]
+        if not pending:
+            return
+
+        wanted = {}
+        for weight in pending:
+            for name in self._local_candidates(weight, self.specs[weight]):
+                wanted.setdefault(name.lower(), weight)
+
+        found = {}
+        for base in dirs:
+            if not base.is_dir(): continue
+            if recursive:
+                listing = ((Path(root), files) for root, _, files in os.walk(base))
+            else:
+                try:
+                    listing = [(base, [p.name for p in base.iterdir() if p.is_file()])]
+                except OSError as e:
+                    logger.warning(f"[Menu] 无法读取字体目录 {base}: {e}")
+                    continue
+            for root, files in listing:
+                for name in files:
+                    weight = wanted.get(name.lower())
+                    path = root / name
+                    with self._lock:
+                        bad = path in self._bad
+                    if weight and weight not in found and not bad and self._is_loadable(path):
+                        found[weight] = path
+                if len(found) == len(pending): break
+            if len(found) == len(pending): break
+
+        for weight, path in found.items():
+            logger.info(f"[Menu] 使用本地字体 {weight}: {path}")
+        with self._lock:
+            self._resolved.update(found)
+            self._unverified.difference_update(found)
+
+    # --- 下载 ---
+
+    def _fetch_weight(self, weight) -> bool:
+        spec = self.specs[weight]
+        url = self.upstream_base + spec["file"]
+        dest = self.target_path(weight)
+        with self._lock:
+            unverified = weight in self._unverified
+        for mirror in self.mirrors:
+            if self._stop.is_set(): return False
+            try:
+                if unverified and dest.exists() and self._matches_remote(mirror + url, dest, spec.get("sha256")):
+                    self._record(dest.name, dest)
+                    logger.info(f"[Menu] 字体 {weight} 已核对为完整文件 ({mirror or '直连'})")
+                else:
+                    self._download(mirror + url, dest, spec.get("sha256"))
+                    logger.info(f"[Menu] 字体 {weight} 下载完成 ({mirror or '直连'})")
+                with self._lock:
+                    self._resolved[weight] = dest
+                    self._checked.add(dest)
+                    self._unverified.discard(weight)
+                return True
+            except Exception as e:
+                logger.warning(f"[Menu] 字体 {weight} 从 {mirror or '直连'} 下载失败: {e}")
+        return False
+
+    def _matches_remote(self, url, path: Path, sha256=None) -> bool:
+        """用 HEAD 的 Content-Length 核对旧文件是否完整"""
+        req = urllib.request.Request(url, method="HEAD", headers={"User-Agent": "astrbot_plugin_menu_core"})
+        with urllib.request.urlopen(req, timeout=self.timeout) as resp:
+            length = resp.headers.get("Content-Length")
+        if not length or int(length) != path.stat().st_size:
+            return False
+        return not sha256 or self._sha256(path) == sha256
+
+    @staticmethod
+    def _validator_of(resp):
+        # If-Range 只接受强 ETag，否则退回 Last-Modified
+        etag = resp.headers.get("ETag")
+        if etag and not etag.startswith("W/"):
+            return etag
+        return resp.headers.get("Last-Modified")
+
+    @staticmethod
+    def _load_validator(meta: Path):
+        try:
+            with open(meta, "r", encoding="utf-8") as f:
+                return json.load(f).get("validator")
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def _save_validator(meta: Path, url, validator):
+        if not validator:
+            meta.unlink(missing_ok=True)
+            return
+        with open(meta, "w", encoding="utf-8") as f:
+            json.dump({"url": url, "validator": validator}, f)
+
+    def _download(self, url, dest: Path, sha256=None):
+        """下载到 .part 临时文件，凭 If-Range 断点续传，校验通过后记入清单并原子替换"""
+        part = dest.with_name(dest.name + ".part")
+        meta = dest.with_name(dest.name + ".part.json")
+
+        def drop_part():
+            part.unlink(missing_ok=True)
+            meta.unlink(missing_ok=True)
+
+        offset, validator = 0, None
+        if part.exists():
+            validator = self._load_validator(meta)
+            # 无法确认残片与远端是同一文件时不续传
+            if validator or sha256:
+                offset = part.stat().st_size
+            else:
+                drop_part()
+
+        req = urllib.request.Request(url, headers={"User-Agent": "astrbot_plugin_menu_core"})
+        if offset:
+            req.add_header("Range", f"bytes={offset}-")
+            if validator: req.add_header("If-Range", validator)
+
+        try:
+            resp = urllib.request.urlopen(req, timeout=self.timeout)
+        except urllib.error.HTTPError as e:
+            # 续传区间无效(本地残片已超出远端大小)，丢弃残片让下一个镜像重新下载
+            if e.code == 416: drop_part()
+            raise
+
+        with resp:
+            total = None
+            if resp.status == 206:
+                m = re.match(r"bytes (\d+)-\d+/(\d+)", resp.headers.get("Content-Range", ""))
+                if not m or int(m.group(1)) != offset:
+                    raise ValueError("续传区间与本地不一致")
+                current = self._validator_of(resp)
+                if validator and current and current != validator:
+                    drop_part()
+                    raise ValueError("远端文件已变化，续传作废")
+                total = int(m.group(2))
+                mode = "ab"
+            else:
+                # 服务端不续传(不支持 Range 或 If-Range 不匹配)，从头开始
+                length = resp.headers.get("Content-Length")
+                total = int(length) if length else None
+                # 既无长度又无哈希时无法确认下载完整
+                if total is None and not sha256:
+                    raise ValueError("响应缺少 Content-Length，且未配置 sha256，无法校验")
+                self._save_validator(meta, url, self._validator_of(resp))
+                mode = "wb"
+
+            with open(part, mode) as f:
+                while True:
+                    if self._stop.is_set():
+                        raise InterruptedError("下载已取消")
+                    chunk = resp.read(CHUNK_SIZE)
+                    if not chunk: break
+                    f.write(chunk)
+
+        size = part.stat().st_size
+        if total is not None and size != total:
+            if size > total: drop_part()
+            raise ValueError(f"文件不完整 ({size}/{total} 字节)")
+        if sha256 and self._sha256(part) != sha256:
+            drop_part()
+            raise ValueError("sha256 校验失败")
+        if not self._is_loadable(part):
+            drop_part()
+            raise ValueError("不是有效的字体文件")
+
+        # 先记清单再替换：中途崩溃时旧文件会因与清单不符而被重新下载
+        self._record(dest.name, part)
+        os.replace(part, dest)
+        meta.unlink(missing_ok=True)
+
+    @staticmethod
+    def _sha256(path: Path) -> str:
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                h.update(chunk)
+        return h.hexdigest()
+
+    @staticmethod
+    def _is_loadable(path: Path) -> bool:
+        try:
+            ImageFont.truetype(str(path), 12)
+            return True
+        except OSError:
+            return False
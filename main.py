@@ -6,6 +6,7 @@ from astrbot.api.event import filter
 
 # 引入分层模块
 from . import storage
+from .fonts import FontManager
 from .renderer import MenuRenderer
 from .web_server import WebManager
 
@@ -26,8 +27,9 @@ class CustomMenuPlugin(Star):
         # 2. 初始化 Web 管理层
         self.web_manager = WebManager(config, self.storage)
         
-        # 3. 初始化渲染层
-        self.renderer = MenuRenderer(self.storage)
+        # 3. 初始化字体与渲染层
+        self.font_manager = FontManager(config, self.storage)
+        self.renderer = MenuRenderer(self.storage, self.font_manager)
         
         # 4. 依赖注入：将渲染器交给 Web 管理器 (用于预览功能)
         self.web_manager.set_renderer(self.renderer)
@@ -46,12 +48,16 @@ class CustomMenuPlugin(Star):
             try: import PIL
             except ImportError: raise ImportError("缺少 Pillow 库")
             
+            # 后台准备字体，不阻塞初始化
+            self.font_manager.ensure_background()
+            
             logger.info("✅ [CustomMenuPlugin] 初始化完成")
         except Exception as e:
             logger.error(f"❌ 初始化失败: {traceback.format_exc()}")
             self.web_manager.set_error(str(e))
 
     async def on_unload(self):
+        await self.font_manager.close()
         await self.web_manager.stop()
 
     def is_admin(self, event_obj: event.AstrMessageEvent) -> bool:
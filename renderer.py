@@ -1,53 +1,25 @@
 import asyncio
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image, ImageDraw
 from pathlib import Path
 import random
 import math
-import urllib.request
 import traceback
 
 class MenuRenderer:
-    def __init__(self, storage_instance):
+    def __init__(self, storage_instance, font_manager):
         self.storage = storage_instance
-        self.font_dir = self.storage.font_dir
-        self.fonts = {
-            "heavy":   self.font_dir / "font_heavy.otf",
-            "bold":    self.font_dir / "font_bold.otf",
-            "medium":  self.font_dir / "font_medium.otf",
-            "regular": self.font_dir / "font_regular.otf"
-        }
-        self.urls = {
-            "heavy":   "https://github.com/adobe-fonts/source-han-sans/raw/release/OTF/SimplifiedChinese/SourceHanSansSC-Heavy.otf",
-            "bold":    "https://github.com/adobe-fonts/source-han-sans/raw/release/OTF/SimplifiedChinese/SourceHanSansSC-Bold.otf",
-            "medium":  "https://github.com/adobe-fonts/source-han-sans/raw/release/OTF/SimplifiedChinese/SourceHanSansSC-Medium.otf",
-            "regular": "https://github.com/adobe-fonts/source-han-sans/raw/release/OTF/SimplifiedChinese/SourceHanSansSC-Regular.otf"
-        }
-        self.mirror_base = "https://ghproxy.net/"
+        self.font_manager = font_manager
 
     async def render_menu_image(self) -> Path:
-        if not all(path.exists() for path in self.fonts.values()):
-            await self._download_font_async()
+        # 缺失的字重在后台补齐，本次直接用已就绪的字重渲染
+        self.font_manager.ensure_background()
         return await asyncio.to_thread(self._render_logic)
 
     def render_sync_for_web(self, config_data) -> Path:
         return self._render_logic(config_data)
 
-    async def _download_font_async(self):
-        await asyncio.to_thread(self._ensure_font_exists_sync)
-
-    def _ensure_font_exists_sync(self):
-        if not self.font_dir.exists(): 
-            self.font_dir.mkdir(parents=True, exist_ok=True)
-        for style, path in self.fonts.items():
-            if not path.exists():
-                try: urllib.request.urlretrieve(self.mirror_base + self.urls[style], path)
-                except: pass
-
     def _get_font(self, size, weight="regular"):
-        target_path = self.fonts.get(weight, self.fonts["regular"])
-        if target_path.exists():
-            return ImageFont.truetype(str(target_path), int(size))
-        return ImageFont.load_default()
+        return self.font_manager.get_font(size, weight)
 
     def _draw_text_centered(self, draw, text, font, center_y, width, align='left', color=(255,255,255), padding=90):
         try: text_len = draw.textlength(text, font=font)
@@ -0,0 +1,18 @@
+import logging
+import sys
+import types
+from pathlib import Path
+
+# 插件以包形式被 AstrBot 加载，测试时直接把插件根目录加入路径
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+# 宿主 AstrBot 通常不在开发环境中，这里只需要 astrbot.api.logger
+try:
+    import astrbot.api  # noqa: F401
+except ImportError:
+    astrbot = types.ModuleType("astrbot")
+    api = types.ModuleType("astrbot.api")
+    api.logger = logging.getLogger("astrbot")
+    astrbot.api = api
+    sys.modules["astrbot"] = astrbot
+    sys.modules["astrbot.api"] = api
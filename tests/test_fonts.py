@@ -0,0 +1,387 @@
+import asyncio
+import hashlib
+import json
+import pathlib
+import threading
+import socket
+import types
+import urllib.error
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+ImageFont = pytest.importorskip("PIL.ImageFont")
+
+import fonts
+from renderer import MenuRenderer
+
+FONT_FILE = "SourceHanSansSC-Regular.otf"
+
+
+@pytest.fixture(scope="module")
+def font_bytes():
+    data = getattr(ImageFont.load_default(size=12), "font_bytes", None)
+    if not data:
+        pytest.skip("Pillow 版本过旧，没有内置 TrueType 字体")
+    return data
+
+
+def etag_of(data):
+    return '"%s"' % hashlib.sha1(data).hexdigest()[:16]
+
+
+class StandIn(BaseHTTPRequestHandler):
+    """本地 HTTP 替身：按路径返回预设内容，可模拟续传、If-Range、416、截断、慢速等情况"""
+    routes = {}
+    requests = []
+    release = threading.Event()
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        mode, data = self.routes.get(self.path, ("404", b""))
+        self.requests.append(("HEAD", self.path, None, None))
+        if mode == "404":
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("ETag", etag_of(data))
+        self.end_headers()
+
+    def do_GET(self):
+        mode, data = self.routes.get(self.path, ("404", b""))
+        rng, if_range = self.headers.get("Range"), self.headers.get("If-Range")
+        self.requests.append(("GET", self.path, rng, if_range))
+
+        if mode == "404":
+            self.send_error(404)
+            return
+        if rng and mode == "ok" and (if_range is None or if_range == etag_of(data)):
+            start = int(rng.split("=")[1].rstrip("-"))
+            if start >= len(data):
+                self.send_error(416)
+                return
+            body = data[start:]
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{len(data) - 1}/{len(data)}")
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("ETag", etag_of(data))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        self.send_response(200)
+        if mode != "chunked":
+            self.send_header("Content-Length", str(len(data)))
+            self.send_header("ETag", etag_of(data))
+        self.end_headers()
+        if mode == "short":
+            self.wfile.write(data[: len(data) // 2])
+        elif mode == "slow":
+            self.wfile.write(data[:100])
+            self.wfile.flush()
+            self.release.wait(10)
+            self.wfile.write(data[100:])
+        else:
+            self.wfile.write(data)
+        self.close_connection = True
+
+
+@pytest.fixture
+def server():
+    StandIn.routes = {}
+    StandIn.requests = []
+    StandIn.release = threading.Event()
+    srv = ThreadingHTTPServer(("127.0.0.1", 0), StandIn)
+    srv.daemon_threads = True
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    yield srv, f"http://127.0.0.1:{srv.server_address[1]}/"
+    StandIn.release.set()
+    srv.shutdown()
+    srv.server_close()
+
+
+def dead_mirror():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return f"http://127.0.0.1:{s.getsockname()[1]}/"
+
+
+def make_manager(tmp_path, mirrors=None, **config):
+    config.setdefault("font_use_system", False)
+    fm = fonts.FontManager(config, types.SimpleNamespace(font_dir=tmp_path))
+    fm.upstream_base = "fonts/"
+    if mirrors is not None:
+        fm.mirrors = list(mirrors)
+    fm.timeout = 5
+    return fm
+
+
+def serve_all(data, mode="ok"):
+    for spec in fonts.FONT_SPECS.values():
+        StandIn.routes["/fonts/" + spec["file"]] = (mode, data)
+
+
+def part_of(fm, weight="regular"):
+    dest = fm.target_path(weight)
+    return dest.with_name(dest.name + ".part"), dest.with_name(dest.name + ".part.json")
+
+
+def test_full_download_renames_into_place(tmp_path, server, font_bytes):
+    srv, base = server
+    StandIn.routes["/fonts/" + FONT_FILE] = ("ok", font_bytes)
+    fm = make_manager(tmp_path, [base])
+
+    assert fm._fetch_weight("regular")
+    assert fm.target_path("regular").read_bytes() == font_bytes
+    assert not list(tmp_path.glob("*.part*"))
+    assert fm.available()["regular"] == fm.target_path("regular")
+
+    manifest = json.loads((tmp_path / fonts.MANIFEST_NAME).read_text())
+    assert manifest["font_regular.otf"] == {
+        "size": len(font_bytes), "sha256": hashlib.sha256(font_bytes).hexdigest()}
+
+
+def test_resume_from_part_with_if_range(tmp_path, server, font_bytes):
+    srv, base = server
+    url = base + "fonts/" + FONT_FILE
+    StandIn.routes["/fonts/" + FONT_FILE] = ("ok", font_bytes)
+    fm = make_manager(tmp_path, [base])
+    part, meta = part_of(fm)
+    part.write_bytes(font_bytes[:1000])
+    fm._save_validator(meta, url, etag_of(font_bytes))
+
+    fm._download(url, fm.target_path("regular"))
+
+    assert StandIn.requests == [("GET", "/fonts/" + FONT_FILE, "bytes=1000-", etag_of(font_bytes))]
+    assert fm.target_path("regular").read_bytes() == font_bytes
+    assert not part.exists() and not meta.exists()
+
+
+def test_changed_remote_restarts_download(tmp_path, server, font_bytes):
+    srv, base = server
+    url = base + "fonts/" + FONT_FILE
+    StandIn.routes["/fonts/" + FONT_FILE] = ("ok", font_bytes)
+    fm = make_manager(tmp_path, [base])
+    part, meta = part_of(fm)
+    part.write_bytes(b"x" * 1000)
+    fm._save_validator(meta, url, '"stale"')
+
+    fm._download(url, fm.target_path("regular"))
+
+    assert fm.target_path("regular").read_bytes() == font_bytes
+
+
+def test_part_without_validator_is_not_resumed(tmp_path, server, font_bytes):
+    srv, base = server
+    StandIn.routes["/fonts/" + FONT_FILE] = ("ok", font_bytes)
+    fm = make_manager(tmp_path, [base])
+    part, _ = part_of(fm)
+    part.write_bytes(b"x" * 1000)
+
+    fm._download(base + "fonts/" + FONT_FILE, fm.target_path("regular"))
+
+    assert StandIn.requests[0][2] is None
+    assert fm.target_path("regular").read_bytes() == font_bytes
+
+
+def test_416_discards_part(tmp_path, server, font_bytes):
+    srv, base = server
+    url = base + "fonts/" + FONT_FILE
+    StandIn.routes["/fonts/" + FONT_FILE] = ("ok", font_bytes)
+    fm = make_manager(tmp_path, [base])
+    part, meta = part_of(fm)
+    part.write_bytes(font_bytes + b"garbage")
+    fm._save_validator(meta, url, etag_of(font_bytes))
+
+    with pytest.raises(urllib.error.HTTPError):
+        fm._download(url, fm.target_path("regular"))
+    assert not part.exists() and not meta.exists()
+    assert not fm.target_path("regular").exists()
+
+
+def test_short_body_leaves_no_dest(tmp_path, server, font_bytes):
+    srv, base = server
+    StandIn.routes["/fonts/" + FONT_FILE] = ("short", font_bytes)
+    fm = make_manager(tmp_path, [base])
+
+    with pytest.raises(Exception):
+        fm._download(base + "fonts/" + FONT_FILE, fm.target_path("regular"))
+    assert not fm.target_path("regular").exists()
+
+
+def test_unsized_response_without_hash_rejected(tmp_path, server, font_bytes):
+    srv, base = server
+    StandIn.routes["/fonts/" + FONT_FILE] = ("chunked", font_bytes)
+    fm = make_manager(tmp_path, [base])
+
+    with pytest.raises(ValueError):
+        fm._download(base + "fonts/" + FONT_FILE, fm.target_path("regular"))
+    assert not fm.target_path("regular").exists()
+
+
+def test_sha256_checked(tmp_path, server, font_bytes):
+    srv, base = server
+    StandIn.routes["/fonts/" + FONT_FILE] = ("chunked", font_bytes)
+    fm = make_manager(tmp_path, [base], font_sha256={"regular": "0" * 64})
+
+    assert not fm._fetch_weight("regular")
+    assert not fm.target_path("regular").exists()
+    assert not list(tmp_path.glob("*.part*"))
+
+
+def test_non_font_body_rejected(tmp_path, server):
+    srv, base = server
+    StandIn.routes["/fonts/" + FONT_FILE] = ("ok", b"<html>rate limited</html>" * 50)
+    fm = make_manager(tmp_path, [base])
+
+    with pytest.raises(ValueError):
+        fm._download(base + "fonts/" + FONT_FILE, fm.target_path("regular"))
+    assert not fm.target_path("regular").exists()
+    assert not list(tmp_path.glob("*.part*"))
+
+
+def test_falls_back_to_next_mirror(tmp_path, server, font_bytes):
+    srv, base = server
+    StandIn.routes["/fonts/" + FONT_FILE] = ("ok", font_bytes)
+    fm = make_manager(tmp_path, [dead_mirror(), base])
+
+    assert fm._fetch_weight("regular")
+    assert fm.target_path("regular").read_bytes() == font_bytes
+
+
+def test_parallel_fetch_from_configured_mirrors(tmp_path, server, font_bytes):
+    srv, base = server
+    serve_all(font_bytes)
+    fm = make_manager(tmp_path, font_mirrors=[dead_mirror().rstrip("/"), base])
+
+    found = fm.ensure_fonts_sync()
+
+    assert set(found) == set(fonts.FONT_SPECS)
+    for weight in fonts.FONT_SPECS:
+        assert fm.target_path(weight).read_bytes() == font_bytes
+    assert fm.missing() == []
+    assert fm._last_failed is None
+
+
+def test_get_font_uses_nearest_weight(tmp_path, font_bytes):
+    fm = make_manager(tmp_path, [])
+    fm.target_path("bold").write_bytes(font_bytes)
+    fm.target_path("regular").write_bytes(font_bytes)
+
+    assert fm.get_font(20, "heavy").path == str(fm.target_path("bold"))
+    assert fm.get_font(20, "medium").path == str(fm.target_path("regular"))
+    assert set(fm.missing()) == set(fonts.FONT_SPECS)
+
+
+def test_unverified_truncated_target_is_redownloaded(tmp_path, server, font_bytes):
+    srv, base = server
+    StandIn.routes["/fonts/" + FONT_FILE] = ("ok", font_bytes)
+    fm = make_manager(tmp_path, [base])
+    fm.target_path("regular").write_bytes(font_bytes[: int(len(font_bytes) * 0.9)])
+
+    assert "regular" in fm.missing()
+    assert fm._fetch_weight("regular")
+    assert fm.target_path("regular").read_bytes() == font_bytes
+    assert "regular" not in fm.missing()
+
+
+def test_unverified_complete_target_adopted_via_head(tmp_path, server, font_bytes):
+    srv, base = server
+    StandIn.routes["/fonts/" + FONT_FILE] = ("ok", font_bytes)
+    fm = make_manager(tmp_path, [base])
+    fm.target_path("regular").write_bytes(font_bytes)
+
+    assert "regular" in fm.missing()
+    assert fm._fetch_weight("regular")
+    assert [r[0] for r in StandIn.requests] == ["HEAD"]
+    assert "font_regular.otf" in json.loads((tmp_path / fonts.MANIFEST_NAME).read_text())
+
+
+def test_target_not_matching_manifest_is_removed(tmp_path, server, font_bytes):
+    srv, base = server
+    StandIn.routes["/fonts/" + FONT_FILE] = ("ok", font_bytes)
+    assert make_manager(tmp_path, [base])._fetch_weight("regular")
+    target = tmp_path / "font_regular.otf"
+    target.write_bytes(font_bytes[: int(len(font_bytes) * 0.9)])
+
+    fm = make_manager(tmp_path, [base])
+    assert "regular" not in fm.available()
+    assert not target.exists()
+
+
+def test_local_dir_resolved_synchronously(tmp_path, font_bytes):
+    local = tmp_path / "local"
+    local.mkdir()
+    (local / "SourceHanSansSC-Medium.otf").write_bytes(font_bytes)
+    fm = make_manager(tmp_path / "fonts", [], font_local_dir=str(local))
+
+    assert fm.available() == {"medium": local / "SourceHanSansSC-Medium.otf"}
+    assert fm.get_font(20, "regular").path == str(local / "SourceHanSansSC-Medium.otf")
+
+
+def test_unreadable_local_dir_is_skipped(tmp_path, monkeypatch):
+    local = tmp_path / "local"
+    local.mkdir()
+
+    def denied(self):
+        raise PermissionError(13, "Permission denied", str(self))
+    monkeypatch.setattr(pathlib.Path, "iterdir", denied)
+
+    fm = make_manager(tmp_path / "fonts", [], font_local_dir=str(local))
+    assert fm.available() == {}
+
+
+def test_mirror_config_normalized():
+    fm = fonts.FontManager({"font_mirrors": [], "font_use_system": False},
+                           types.SimpleNamespace(font_dir=None))
+    assert fm.mirrors == [""]
+    fm = fonts.FontManager({"font_mirrors": ["https://ghproxy.net", " "], "font_use_system": False},
+                           types.SimpleNamespace(font_dir=None))
+    assert fm.mirrors == ["https://ghproxy.net/", ""]
+    fm = fonts.FontManager({"font_use_system": False}, types.SimpleNamespace(font_dir=None))
+    assert fm.mirrors == fonts.DEFAULT_MIRRORS + [""]
+
+
+def test_failed_run_waits_for_cooldown(tmp_path):
+    fm = make_manager(tmp_path, [dead_mirror()])
+
+    async def run():
+        await fm.ensure_background()
+        assert fm._last_failed is not None
+        assert fm.ensure_background() is None
+        task = fm.ensure_background(force=True)
+        assert task is not None
+        await task
+        await fm.close()
+        assert fm.ensure_background(force=True) is None
+
+    asyncio.run(run())
+
+
+def test_render_does_not_wait_for_download(tmp_path, server, font_bytes):
+    srv, base = server
+    serve_all(font_bytes, mode="slow")
+    local = tmp_path / "local"
+    local.mkdir()
+    (local / FONT_FILE).write_bytes(font_bytes)
+    fm = make_manager(tmp_path / "fonts", font_mirrors=[base], font_local_dir=str(local))
+
+    config = {"title": "菜单", "design": {"layout_columns": 2},
+              "menus": [{"name": "帮助", "desc": "查看使用说明", "enabled": True}]}
+    storage = types.SimpleNamespace(load_config=lambda: config, bot_data_root=tmp_path)
+    renderer = MenuRenderer(storage, fm)
+
+    async def run():
+        image = await asyncio.wait_for(renderer.render_menu_image(), timeout=5)
+        assert image.exists()
+        assert fm._task is not None and not fm._task.done()
+        assert fm.available() == {"regular": local / FONT_FILE}
+
+        StandIn.release.set()
+        await asyncio.wait_for(fm._task, timeout=10)
+        assert set(fm.available()) == set(fonts.FONT_SPECS)
+
+    asyncio.run(run())